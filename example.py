@@ -10,6 +10,7 @@ if __name__ == '__main__' and __package__ is None:
     sys.path.append('%s/..' % sys.path[0])
 
 import decimal
+import re
 
 from . import lex
 from . import parse
@@ -30,7 +31,8 @@ table = {
     'RPAREN':     r'\)',
     'WHITESPACE': (r'[ \t\n]+', lambda t: None),
 }
-lexer = lex.Lexer(table)
+# The token regexes only ever match ASCII, so tell the regex engine that up front
+lexer = lex.Lexer(table, flags=re.ASCII)
 
 def reduce_binop(p):
     r = p[0]
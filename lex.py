@@ -1,5 +1,5 @@
-import copy
 import re
+import sys
 
 class LexError(SyntaxError):
     def __init__(self, msg, info=None):
@@ -8,6 +8,7 @@ class LexError(SyntaxError):
 
 # Info means basically filename/line number, used for reporting errors
 class Info:
+    __slots__ = ['filename', 'lineno', 'textpos', 'column', 'length']
     def __init__(self, filename, lineno=1, textpos=0, column=0, length=0):
         self.filename = filename
         self.lineno = lineno
@@ -18,21 +19,51 @@ class Info:
         return 'Info("%s", %s, %s, %s)' % (self.filename, self.lineno, self.column, self.length)
 
 class Token:
+    __slots__ = ['type', 'value', 'info']
     def __init__(self, type, value, info=None):
         self.type = type
         self.value = value
         self.info = info
+    # Calling the constructor directly is a good deal faster than copy.copy(),
+    # and this runs once per token in lexers with transformation functions
     def copy(self, type=None, value=None, info=None):
-        c = copy.copy(self)
-        if type is not None:  c.type = type
-        if value is not None: c.value = value
-        if info is not None:  c.info = info
-        return c
+        return Token(self.type if type is None else type,
+                self.value if value is None else value,
+                self.info if info is None else info)
     def __repr__(self):
         return 'Token(%s, %r, info=%s)' % (self.type, self.value, self.info)
 
+# Conservative check for whether a regex could ever match a newline: a literal
+# newline, '[^' (negated classes usually include it), an escape class that covers it
+# (\s etc.), an escape that could be a range endpoint spanning it (e.g. [\t-\r]),
+# or an inline DOTALL flag, under which '.' matches newlines too. The flag can be
+# buried anywhere in a group's flag list ((?is:...), (?ms)...), so that check needs
+# a regex of its own rather than a substring.
+# False negatives here would break line numbering, false positives only cost a
+# substring scan per token, so err well on the side of matching.
+_NL_MARKERS = ('\n', r'\n', r'\s', r'\S', r'\W', r'\D', r'\t', r'\v', r'\f',
+        r'\r', r'\x', r'\0', r'\u', r'\U', r'\N', '[^')
+_NL_FLAG_RE = re.compile(r'\(\?[a-zA-Z-]*s')
+def might_match_newline(regex):
+    return (any(marker in regex for marker in _NL_MARKERS) or
+            _NL_FLAG_RE.search(regex) is not None)
+
+# Return the character a regex matches if it's a single-character literal (like '-'
+# or '\+'), or None otherwise
+def literal_char(regex):
+    if len(regex) == 1 and regex not in '.^$*+?{}[]|\\':
+        return regex
+    if len(regex) == 2 and regex[0] == '\\' and not regex[1].isalnum():
+        return regex[1]
+    return None
+
 class Lexer:
-    def __init__(self, token_list):
+    __slots__ = ['token_fns', 'flags', 'char_types', 'type_names', 'nl_types',
+            'pattern', 'finditer']
+    # Extra regex flags (say, re.ASCII to keep \w/\s and friends out of the slower
+    # full-Unicode matching paths) get ORed into the re.MULTILINE we always use
+    def __init__(self, token_list, flags=0):
+        self.flags = flags
         self._set_token_list(token_list)
 
     # This is used for setting the list of accepted tokens, either when the lexer
@@ -44,63 +75,182 @@ class Lexer:
             token_list = sorted(token_list.items(), key=lambda item: -len(item[1]))
         sorted_tokens = []
         for k, v in token_list:
+            # Intern the token type names--the parser interns the names in its rules
+            # too, so the type comparisons in accept() hit the pointer-equality fast path
+            k = sys.intern(k)
             if isinstance(v, tuple):
                 v, fn = v
                 self.token_fns[k] = fn
             sorted_tokens.append([k, v])
+        # Precompute which token types could possibly span a line, so the lex loops
+        # below can skip the newline bookkeeping for all the ones that can't. Under
+        # re.DOTALL any '.' matches a newline, so the syntactic check is useless--
+        # just treat every token as newline-capable there
+        if self.flags & re.DOTALL:
+            self.nl_types = {k for k, v in sorted_tokens}
+        else:
+            self.nl_types = {k for k, v in sorted_tokens if might_match_newline(v)}
+
+        # Collapse any trailing run of single-character literal tokens (operators,
+        # punctuation, etc.) into one character class, so the regex engine has far fewer
+        # alternatives to try per match. The matched character is mapped back to its real
+        # token type with a dict lookup in the lex loop. Only a trailing run is merged,
+        # since earlier alternatives take priority (e.g. '->' must win over '-').
+        i = len(sorted_tokens)
+        while i > 0 and literal_char(sorted_tokens[i-1][1]) is not None:
+            i -= 1
+        tail = sorted_tokens[i:]
+        if len(tail) > 1 and not any(k == '_CHARS' for k, v in sorted_tokens):
+            self.char_types = {}
+            # Walk the run backwards so that on (degenerate) duplicate characters, the
+            # earliest token still wins, like it would in the alternation
+            for k, v in reversed(tail):
+                self.char_types[literal_char(v)] = k
+            sorted_tokens[i:] = [['_CHARS',
+                    '[%s]' % ''.join(re.escape(c) for c in self.char_types)]]
+        else:
+            self.char_types = None
+        # Map the group names the regex engine hands back (which aren't the same string
+        # objects we were given) to the interned names
+        self.type_names = {k: k for k, v in sorted_tokens}
+
         regex = '|'.join('(?P<%s>%s)' % (k, v) for k, v in sorted_tokens)
-        self.matcher = re.compile(regex, re.MULTILINE).match
+        # Tokenization depends on the stdlib engine's semantics: alternatives match
+        # leftmost-first (that's how token priority works) and lastgroup tells us which
+        # token matched. DFA-based engines (Hyperscan, re2) and the PCRE2 bindings don't
+        # offer both, so don't swap this out without rethinking precedence.
+        self.pattern = re.compile(regex, re.MULTILINE | self.flags)
+        self.finditer = self.pattern.finditer
 
     def lex_input(self, text, filename):
-        match = self.matcher(text)
         lineno = 1
         last_newline = 0
-        end = 0
-        while match is not None:
+        pos = 0
+        while pos < len(text):
+            # Iterate over all the matches with a single C-level loop. We only break out of
+            # it early when the consumer swaps in a new token list, in which case we need to
+            # recompile the token regex and pick up scanning where we left off.
+            new_token_list = None
+            token_fns = self.token_fns
+            char_types = self.char_types
+            type_names = self.type_names
+            nl_types = self.nl_types
+            for match in self.finditer(text, pos):
+                # span() gets both match bounds with one call, and slicing the input is
+                # cheaper than asking the match object for the matched text
+                start, end = match.span()
+                # finditer() can silently skip past characters that don't match the regex,
+                # unlike the old anchored match() loop--treat any gap as a lexing error
+                if start != pos:
+                    break
+                pos = end
+                type = match.lastgroup
+                value = text[start:end]
+                type = char_types[value] if type == '_CHARS' else type_names[type]
+
+                token = Token(type, value)
+                fn = token_fns.get(type)
+                if fn is not None:
+                    token = fn(token)
+                # If the token isn't skipped, set the info and add it to the tokens list
+                if token:
+                    token.info = Info(filename, lineno, start, start - last_newline, end - start)
+                    # This is actually a coroutine--check if the consumer has provided a new
+                    # set of tokens to accept.
+                    new_token_list = (yield token)
+
+                # If there's a newline in this token, bump the newline count, and save the position
+                # of the last newline (so we know what column a given character is in)
+                if type in nl_types and '\n' in value:
+                    lineno += value.count('\n')
+                    last_newline = end - value.rfind('\n')
+
+                if new_token_list:
+                    self._set_token_list(new_token_list)
+                    break
+            if not new_token_list:
+                break
+
+        # Check for invalid input--we didn't reach the end of the input
+        if pos != len(text):
+            info = Info(filename, lineno, pos, pos - last_newline, 1)
+            raise LexError('tokenizing error, invalid input', info=info)
+
+    # The eager version of lex_input() above: lex the whole input up front into a plain
+    # list, with no coroutine machinery. A lexing error isn't raised here--it's returned
+    # alongside the tokens so the parser only hits it if it actually reads that far,
+    # matching the old lazy-generator behavior.
+    def _lex_all(self, text, filename):
+        tokens = []
+        append = tokens.append
+        token_fns = self.token_fns
+        char_types = self.char_types
+        type_names = self.type_names
+        nl_types = self.nl_types
+        lineno = 1
+        last_newline = 0
+        pos = 0
+        for match in self.finditer(text):
+            start, end = match.span()
+            if start != pos:
+                break
+            pos = end
             type = match.lastgroup
-            value = match.group(type)
-            start, end = match.start(), match.end()
+            value = text[start:end]
+            type = char_types[value] if type == '_CHARS' else type_names[type]
 
             token = Token(type, value)
-            if type in self.token_fns:
-                token = self.token_fns[type](token)
-            # If the token isn't skipped, set the info and add it to the tokens list
+            fn = token_fns.get(type)
+            if fn is not None:
+                token = fn(token)
             if token:
                 token.info = Info(filename, lineno, start, start - last_newline, end - start)
-                # This is actually a coroutine--check if the consumer has provided a new
-                # set of tokens to accept.
-                new_token_list = (yield token)
-                if new_token_list:
-                    self._set_token_list(new_token_list)
+                append(token)
 
-            # If there's a newline in this token, bump the newline count, and save the position
-            # of the last newline (so we know what column a given character is in)
-            if '\n' in value:
+            if type in nl_types and '\n' in value:
                 lineno += value.count('\n')
                 last_newline = end - value.rfind('\n')
-            match = self.matcher(text, end)
 
-        # Check for invalid input--we didn't reach the end of the input
-        if end != len(text):
-            info = Info(filename, lineno, end, end - last_newline, 1)
-            raise LexError('tokenizing error, invalid input', info=info)
+        error = None
+        if pos != len(text):
+            info = Info(filename, lineno, pos, pos - last_newline, 1)
+            error = LexError('tokenizing error, invalid input', info=info)
+        return (tokens, error)
 
-    def input(self, text, filename=None):
-        return LexerContext(text, self.lex_input(text, filename), filename)
+    def input(self, text, filename=None, lazy=False):
+        # The lazy path keeps the coroutine-based lexer, which is only needed when the
+        # token list can change mid-stream (i.e. set_token_list() might get called)
+        if lazy:
+            return LexerContext(text, self.lex_input(text, filename), filename)
+        tokens, error = self._lex_all(text, filename)
+        return LexerContext(text, tokens, filename, error=error)
 
 class LexerContext:
-    def __init__(self, text, token_stream, filename):
+    __slots__ = ['text', 'pos', 'token_stream', 'token_cache', 'error',
+            'track_errors', 'max_pos', 'max_info', 'max_expected_tokens', 'filename']
+    def __init__(self, text, token_stream, filename, error=None):
         self.text = text
         self.pos = 0
 
-        # The token_stream argument is a generator from the lex_input() function above.
-        # We iterate through it lazily, mostly so that lexing errors aren't raised until
-        # we're actually parsing, not here in the constructor. This is kinda dumb.
-        self.token_stream = iter(token_stream)
-        self.token_cache = []
+        # The token_stream argument is either a list of tokens from _lex_all(), or a
+        # generator from the lex_input() coroutine for the lazy path. In the latter case
+        # we iterate through it lazily, so lexing errors aren't raised until we're
+        # actually parsing, not here in the constructor. A deferred error from _lex_all()
+        # gets the same treatment: it's raised once the parser reads past the last token.
+        if isinstance(token_stream, list):
+            self.token_stream = None
+            self.token_cache = token_stream
+        else:
+            self.token_stream = iter(token_stream)
+            self.token_cache = []
+        self.error = error
 
         # Variables to track the maximum position in the token stream we parsed to,
-        # where that is in a file, and the set of token types that could've come next
+        # where that is in a file, and the set of token types that could've come next.
+        # Maintaining these costs a bit on every accept(), so it's off by default:
+        # when a parse fails, the parser rewinds and runs a second pass with
+        # track_errors on just to reconstruct this information for the error message.
+        self.track_errors = False
         self.max_pos = 0
         self.max_info = None
         self.max_expected_tokens = set()
@@ -123,10 +273,15 @@ class LexerContext:
                 # Simple sentinel: take away the token stream when it's been consumed
                 self.token_stream = None
         if pos >= len(self.token_cache):
+            if self.error:
+                raise self.error
             return None
         return self.token_cache[pos]
 
     def set_token_list(self, tokens):
+        if self.token_stream is None:
+            raise RuntimeError('dynamic token lists need a lazy lexer--use '
+                    'Lexer.input(text, lazy=True)')
         try:
             self.token_cache.append(self.token_stream.send(tokens))
         except StopIteration:
@@ -147,7 +302,10 @@ class LexerContext:
         self.pos = state
 
     def peek(self):
-        return self.token_at(self.pos)
+        # Same inline cache fast path as accept() below
+        pos = self.pos
+        token_cache = self.token_cache
+        return token_cache[pos] if pos < len(token_cache) else self.token_at(pos)
 
     # Return whether we tried to parse past the end of the token stream. Useful for interactive
     # parsing.
@@ -155,18 +313,21 @@ class LexerContext:
         return self.token_stream is None and self.max_pos == len(self.token_cache)
 
     def accept(self, token_type):
-        token = self.peek()
+        # Inline the hot path of peek()/token_at(): in the eager (and warmed-up lazy)
+        # case every lookup lands inside the already-lexed cache, so skip two method
+        # calls and go straight to the list
+        pos = self.pos
+        token_cache = self.token_cache
+        token = token_cache[pos] if pos < len(token_cache) else self.token_at(pos)
 
         # Before we check whether this token is acceptable to the grammar, update the lexer
         # info about the furthest we were able to parse. We maintain a set of expected tokens
         # that could occur at this furthest point, so we can give the user a useful error message.
-        if self.pos >= self.max_pos:
-            if self.pos > self.max_pos:
-                self.max_pos = self.pos
+        if self.track_errors and pos >= self.max_pos:
+            if pos > self.max_pos:
+                self.max_pos = pos
                 self.max_info = token and token.info
-                # Minor optimzation: only reallocate the token set if it's nonempty
-                if self.max_expected_tokens:
-                    self.max_expected_tokens = set()
+                self.max_expected_tokens.clear()
             if token_type != None:
                 self.max_expected_tokens.add(token_type)
 
@@ -176,6 +337,19 @@ class LexerContext:
             return token
         return None
 
+    # Record a whole set of token types that could have matched at the current position,
+    # without accepting any of them. The parser uses this when it rules out alternatives
+    # with precomputed lookahead instead of trying them one by one, so that error
+    # messages still mention every token that could have come next.
+    def note_expected(self, token_types):
+        if self.track_errors and self.pos >= self.max_pos:
+            if self.pos > self.max_pos:
+                self.max_pos = self.pos
+                token = self.peek()
+                self.max_info = token and token.info
+                self.max_expected_tokens.clear()
+            self.max_expected_tokens.update(token_types)
+
     # Kind of a silly function, provided for backwards compatibility
     def next(self):
         token = self.peek()
@@ -184,5 +358,5 @@ class LexerContext:
     def expect(self, token_type):
         token = self.accept(token_type)
         if not token:
-            raise RuntimeError('got %s instead of %s' % (self.peek(), t))
+            raise RuntimeError('got %s instead of %s' % (self.peek(), token_type))
         return token
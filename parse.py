@@ -1,4 +1,3 @@
-import copy
 import sys
 
 from . import lex
@@ -33,18 +32,25 @@ def merge_info_list(info):
                 break
         else:
             assert False
-    info = copy.copy(first)
-    info.length = last.length + (last.textpos - first.textpos)
-    return info
+    # Construct the merged info directly--much cheaper than copying the first
+    # info and patching its length, and this runs per FnWrapper'd rule
+    return lex.Info(first.filename, first.lineno, first.textpos, first.column,
+            last.length + (last.textpos - first.textpos))
 
 # ParseResult works like a tuple for the results of parsed rules, but with an
 # additional .get_info(n...) method for getting line-number information out
 class ParseResult:
+    __slots__ = ['_ctx', 'items', 'info']
     def __init__(self, ctx, items, info):
         self._ctx = ctx
-        self.user_context = ctx.user_context
         self.items = items
         self.info = info
+    # Read through to the context on demand--a ParseResult is allocated for every
+    # rule with a user function, and most of them never look at the user context,
+    # so don't pay for an extra slot and store on each one
+    @property
+    def user_context(self):
+        return self._ctx.user_context
     def __getitem__(self, n):
         return self.items[n]
     def get_info(self, *indices):
@@ -62,21 +68,46 @@ class ParseResult:
         return ParseResult(self._ctx, items or self.items, info or self.info)
 
 class Context:
-    def __init__(self, rule_table, tokenizer, user_context=None):
+    __slots__ = ['rule_table', 'tokenizer', 'user_context', 'memo', 'memo_all', 'cut']
+    def __init__(self, rule_table, tokenizer, user_context=None, memoize=False,
+            memo_rules=False):
         self.rule_table = rule_table
         self.tokenizer = tokenizer
         self.user_context = user_context
+        # Packrat memo table, keyed by (rule name, token position). Only allocated when
+        # the parser asks for it, either for every rule (the memoize flag on Parser) or
+        # for the rules flagged with a per-rule {'memoize': True}.
+        self.memo = {} if memoize or memo_rules else None
+        self.memo_all = memoize
+        # Set when a parse fails past a cut operator--see CutSequence
+        self.cut = False
 
+# Transpose a list of (value, info) pairs into a values list and an infos list.
+# zip(*) does the transposition in C; the empty case needs special handling since
+# zip of nothing yields nothing rather than two empty columns.
 def unzip(results):
-    return [[r[i] for r in results] for i in range(2)]
+    # Short-circuit the overwhelmingly common tiny cases. These still build fresh
+    # lists every time: results are handed to user functions, which are free to
+    # mutate them, so no sharing allowed.
+    if not results:
+        return [[], []]
+    if len(results) == 1:
+        result = results[0]
+        return [[result[0]], [result[1]]]
+    values, infos = zip(*results)
+    return [list(values), list(infos)]
 
 # Classes to represent grammar structure. These are hierarchically nested, and
 # operate through the parse method, usually calling other rules' parse methods.
 
-# Parse either a token or a nonterminal of the grammar
+# Parse either a token or a nonterminal of the grammar. This is just a build-time
+# placeholder: when a Parser finalizes its rule table, every Identifier is replaced
+# with a RuleRef or a TokenRef below, which don't need the table check per parse.
 class Identifier:
+    __slots__ = ['name']
     def __init__(self, name):
-        self.name = name
+        # Interned to match the lexer's token type names, making comparisons cheap
+        self.name = sys.intern(name)
     def parse(self, ctx):
         if self.name in ctx.rule_table:
             return ctx.rule_table[self.name].parse(ctx)
@@ -88,88 +119,583 @@ class Identifier:
     def __str__(self):
         return '"%s"' % self.name
 
+# A direct reference to another rule. Identifier nodes that name a rule get replaced
+# with one of these once the whole rule table is built, so following a nonterminal
+# reference during parsing is an attribute load instead of a dict lookup.
+class RuleRef:
+    __slots__ = ['name', 'target', 'memoized']
+    def __init__(self, name, target, memoized=False):
+        self.name = name
+        self.target = target
+        self.memoized = memoized
+    def parse(self, ctx):
+        memo = ctx.memo
+        if memo is None or not (self.memoized or ctx.memo_all):
+            result = self.target.parse(ctx)
+            # A cut only prunes alternatives of the rule it appears in: clear the
+            # flag at the rule boundary so the commitment can't leak into callers
+            # (which also keeps memo entries below valid for replay)
+            if ctx.cut:
+                ctx.cut = False
+            return result
+        # Packrat path: cache (result, ending position) per starting position, for
+        # successes and failures both. This guarantees linear-time parsing for
+        # grammars with heavy backtracking, at the cost of the table upkeep.
+        key = (self.name, ctx.tokenizer.pos)
+        hit = memo.get(key)
+        if hit is not None:
+            result, end = hit
+            ctx.tokenizer.pos = end
+            return result
+        result = self.target.parse(ctx)
+        if ctx.cut:
+            ctx.cut = False
+        memo[key] = (result, ctx.tokenizer.pos)
+        return result
+    def __str__(self):
+        return '"%s"' % self.name
+
+# A reference to a terminal, i.e. an identifier that doesn't name any rule
+class TokenRef:
+    __slots__ = ['name']
+    def __init__(self, name):
+        self.name = name
+    def parse(self, ctx):
+        token = ctx.tokenizer.accept(self.name)
+        if token:
+            return (token.value, token.info)
+        return None
+    def __str__(self):
+        return '"%s"' % self.name
+
 # Parse a rule repeated at least <min> number of times (used for * and + in EBNF)
 class Repeat:
+    __slots__ = ['item', 'min_reps', 'first']
     def __init__(self, item, min_reps=0):
         self.item = item
         self.min_reps = min_reps
+        # FIRST set of the item, filled in by compile_dispatch() when the item can
+        # never match zero tokens--used to prune doomed iterations below
+        self.first = None
     def parse(self, ctx):
+        # Bind the item's parse method and the append once--this loop runs per
+        # element of every starred rule. Also save the position up front, so a failed
+        # minimum-repetition check rewinds to before the first item, not after it.
+        tokenizer = ctx.tokenizer
+        pos = tokenizer.pos
+        parse_item = self.item.parse
         results = []
-        item = self.item.parse(ctx)
-        state = ctx.tokenizer.get_state()
-        while item:
-            results.append(item)
-            item = self.item.parse(ctx)
+        append = results.append
+        first = self.first
+        if first is not None:
+            # The item has to consume at least one token, and we know which token
+            # types it can start with--check the lookahead before each iteration and
+            # skip the speculative parse-and-rewind when it can't possibly match.
+            # note_expected() keeps the pruned token types in error messages.
+            while True:
+                token = tokenizer.peek()
+                if token is None or token.type not in first:
+                    break
+                item = parse_item(ctx)
+                if item is None:
+                    break
+                append(item)
+            tokenizer.note_expected(first)
+        else:
+            item = parse_item(ctx)
+            while item is not None:
+                append(item)
+                item = parse_item(ctx)
+        # A failure past a cut is committed: fail the whole repetition rather than
+        # stopping the loop and succeeding with the items so far
+        if ctx.cut:
+            tokenizer.pos = pos
+            return None
         if len(results) >= self.min_reps:
             return unzip(results)
-        ctx.tokenizer.restore_state(state)
+        tokenizer.pos = pos
         return None
     def __str__(self):
         return 'rep(%s)' % self.item
 
+# Specialization of Repeat for repeating a plain terminal (think IDENTIFIER*): one
+# tight loop over a bound accept(), with no per-item node dispatch and no unzip()
+# afterwards. Substituted for Repeat during identifier resolution.
+class TokenRepeat(Repeat):
+    __slots__ = []
+    def parse(self, ctx):
+        tokenizer = ctx.tokenizer
+        pos = tokenizer.pos
+        accept = tokenizer.accept
+        name = self.item.name
+        values = []
+        infos = []
+        token = accept(name)
+        while token is not None:
+            values.append(token.value)
+            infos.append(token.info)
+            token = accept(name)
+        if len(values) >= self.min_reps:
+            return [values, infos]
+        tokenizer.pos = pos
+        return None
+
 # Parse a sequence of multiple consecutive rules
 class Sequence:
+    __slots__ = ['items']
     def __init__(self, items):
         self.items = items
     def parse(self, ctx):
-        results = []
-        state = ctx.tokenizer.get_state()
+        # This is the workhorse of the parser, so keep everything the loop touches in
+        # locals: the tokenizer, its position (saved/restored directly rather than via
+        # the get_state/restore_state wrappers), and the bound append method
+        tokenizer = ctx.tokenizer
+        pos = tokenizer.pos
+        values = []
+        infos = []
+        values_append = values.append
+        infos_append = infos.append
         for item in self.items:
             result = item.parse(ctx)
-            if not result:
-                ctx.tokenizer.restore_state(state)
+            if result is None:
+                tokenizer.pos = pos
                 return None
-            results.append(result)
-        return unzip(results)
+            values_append(result[0])
+            infos_append(result[1])
+        return [values, infos]
     def __str__(self):
         return 'seq(%s)' % ','.join(map(str, self.items))
 
+# A sequence containing a cut operator (written ! in the grammar). Once every item
+# before the cut has parsed, the parse is committed to this branch: a failure after
+# the cut sets a flag that makes the enclosing alternation fail outright instead of
+# backtracking into its remaining alternatives (and makes Optional/Repeat pass the
+# failure through instead of swallowing it).
+class CutSequence(Sequence):
+    __slots__ = ['cut_pos']
+    def __init__(self, items, cut_pos):
+        self.items = items
+        self.cut_pos = cut_pos
+    def parse(self, ctx):
+        tokenizer = ctx.tokenizer
+        pos = tokenizer.pos
+        values = []
+        infos = []
+        values_append = values.append
+        infos_append = infos.append
+        for i, item in enumerate(self.items):
+            result = item.parse(ctx)
+            if result is None:
+                tokenizer.pos = pos
+                if i >= self.cut_pos:
+                    ctx.cut = True
+                return None
+            values_append(result[0])
+            infos_append(result[1])
+        return [values, infos]
+
 # Parse one of a choice of multiple rules
 class Alternation:
+    __slots__ = ['items', 'dispatch', 'fallback', 'expected']
     def __init__(self, items):
         self.items = items
+        self.dispatch = None
+        self.fallback = None
+        self.expected = None
+    # Build a lookahead dispatch table from the FIRST set of each alternative: a map
+    # from token type to the alternatives (in order) that can start with that token.
+    # Nullable alternatives could match anything, so they go in every bucket, and in
+    # the fallback list used when the lookahead token doesn't start any alternative.
+    # The dispatch buckets hold the alternatives' bound parse methods rather than
+    # the nodes themselves, saving an attribute lookup per alternative tried
+    def compile_first(self, firsts):
+        tokens = set()
+        for f, nullable in firsts:
+            tokens.update(f)
+        self.dispatch = {t: tuple(item.parse
+                for item, (f, nullable) in zip(self.items, firsts)
+                if t in f or nullable) for t in tokens}
+        self.fallback = tuple(item.parse for item, (f, nullable) in zip(self.items, firsts)
+                if nullable)
+        self.expected = tokens
     def parse(self, ctx):
+        if self.dispatch is not None:
+            # Note every token type this alternation could accept, so the skipped
+            # alternatives still show up in "expected one of..." error messages
+            tokenizer = ctx.tokenizer
+            tokenizer.note_expected(self.expected)
+            token = tokenizer.peek()
+            parses = (self.dispatch.get(token.type, self.fallback)
+                    if token is not None else self.fallback)
+            for parse_item in parses:
+                result = parse_item(ctx)
+                if result is not None:
+                    return result
+                # A failed alternative that crossed a cut rules out the others too
+                if ctx.cut:
+                    ctx.cut = False
+                    break
+            return None
+        # Uncompiled path, only taken for rule trees used outside a Parser
         for item in self.items:
             result = item.parse(ctx)
-            if result:
+            if result is not None:
                 return result
+            if ctx.cut:
+                ctx.cut = False
+                break
         return None
     def __str__(self):
         return 'alt(%s)' % ','.join(map(str, self.items))
 
+# Shared result for an Optional that didn't match--no point building this
+# tuple fresh every time a [rule] gets skipped
+_EMPTY_RESULT = (None, None)
+
 # Either parse a rule or not
 class Optional:
+    __slots__ = ['item']
     def __init__(self, item):
         self.item = item
     def parse(self, ctx):
-        return self.item.parse(ctx) or (None, None)
+        result = self.item.parse(ctx)
+        if result is not None:
+            return result
+        return None if ctx.cut else _EMPTY_RESULT
     def __str__(self):
         return 'opt(%s)' % self.item
 
 # Parse a rule and then call a user-defined function on the result
 class FnWrapper:
+    __slots__ = ['rule', 'fn', 'wrap', 'fast']
     def __init__(self, rule, fn):
-        # Make sure top-level rules are a sequence. When we pass parse results
-        # to the user-defined function, it must be returned in an array, so we
-        # can use the ParseResult class and have access to the parse info
-        if not isinstance(rule, Sequence):
-            rule = Sequence([rule])
+        # When we pass parse results to the user-defined function, they must be in a
+        # list, so we can use the ParseResult class and have access to the parse info.
+        # Sequences already produce that shape; for anything else, rather than wrapping
+        # the rule in a degenerate one-item Sequence (a whole extra parse() call per
+        # invocation), just remember to listify the single result at parse time.
+        self.wrap = not isinstance(rule, Sequence)
         self.rule = rule
         self.fn = fn
+        # If the function references no global/attribute names and closes over
+        # nothing, it can't call any of ParseResult's methods itself, so we skip
+        # allocating the ParseResult and pass the items list directly. Note the
+        # narrowed contract this implies: such a function can still hand its
+        # argument onward (e.g. lambda p: [p]), and whatever receives it then sees
+        # a plain list rather than a ParseResult.
+        code = getattr(fn, '__code__', None)
+        self.fast = (code is not None and not code.co_names and not code.co_freevars)
     def parse(self, ctx):
         result = self.rule.parse(ctx)
-        if result:
-            result, info = result
-            result = self.fn(ParseResult(ctx, result, info))
-            if isinstance(result, ParseResult):
-                result, info = result.items, result.info
-            else:
-                info = merge_info_list(info)
-            return (result, info)
-        return None
+        if result is None:
+            return None
+        values, info = result
+        if self.wrap:
+            values, info = [values], [info]
+        if self.fast:
+            result = self.fn(values)
+            # Returning the argument unchanged mirrors returning the ParseResult:
+            # keep the info structure instead of merging it
+            if result is values:
+                return (values, info)
+            return (result, merge_info_list(info))
+        result = self.fn(ParseResult(ctx, values, info))
+        if isinstance(result, ParseResult):
+            return (result.items, result.info)
+        return (result, merge_info_list(info))
     def __str__(self):
         return str(self.rule)
 
+# Flatten degenerate nodes the grammar mini-parser can produce: alternations
+# nested directly inside alternations (from parenthesized groups, or rules defined
+# in several parts), and doubly-optional items. Both rewrites preserve the shape of
+# parse results--which is why nested sequences are left alone, collapsing those
+# would change what user functions see.
+def simplify(node):
+    if isinstance(node, Alternation):
+        items = []
+        for item in node.items:
+            item = simplify(item)
+            if type(item) is Alternation:
+                items.extend(item.items)
+            else:
+                items.append(item)
+        node.items = items
+    elif isinstance(node, Sequence):
+        node.items = [simplify(item) for item in node.items]
+    elif isinstance(node, (Repeat, Optional)):
+        node.item = simplify(node.item)
+        if isinstance(node, Optional) and isinstance(node.item, Optional):
+            node.item = node.item.item
+    elif isinstance(node, FnWrapper):
+        node.rule = simplify(node.rule)
+    return node
+
+# Replace Identifier nodes with their resolved form now that the full rule table
+# is known: RuleRefs for rule names, TokenRefs for everything else
+def resolve_identifiers(node, rule_table, memo_rules):
+    if isinstance(node, Identifier):
+        if node.name in rule_table:
+            return RuleRef(node.name, rule_table[node.name],
+                    memoized=node.name in memo_rules)
+        return TokenRef(node.name)
+    if isinstance(node, (Sequence, Alternation)):
+        # This is the last pass that restructures the tree, so freeze the item lists
+        # into tuples while we're here--iterating a tuple is a bit faster, and it
+        # makes plain that the grammar is immutable from here on
+        node.items = tuple(resolve_identifiers(item, rule_table, memo_rules)
+                for item in node.items)
+    elif isinstance(node, (Repeat, Optional)):
+        node.item = resolve_identifiers(node.item, rule_table, memo_rules)
+        if type(node) is Repeat and isinstance(node.item, TokenRef):
+            return TokenRepeat(node.item, node.min_reps)
+    elif isinstance(node, FnWrapper):
+        node.rule = resolve_identifiers(node.rule, rule_table, memo_rules)
+    return node
+
+# Lookahead computation for alternation dispatch. compute_first returns the set of
+# token types a grammar node can start with, plus whether it can match zero tokens,
+# in terms of the per-rule sets that Parser iterates to a fixpoint below.
+def compute_first(node, rule_table, first, nullable):
+    if isinstance(node, RuleRef):
+        return (first[node.name], nullable[node.name])
+    if isinstance(node, TokenRef):
+        return ({node.name}, False)
+    if isinstance(node, Sequence):
+        f = set()
+        for item in node.items:
+            item_first, item_nullable = compute_first(item, rule_table, first, nullable)
+            f |= item_first
+            if not item_nullable:
+                return (f, False)
+        return (f, True)
+    if isinstance(node, Alternation):
+        f = set()
+        n = False
+        for item in node.items:
+            item_first, item_nullable = compute_first(item, rule_table, first, nullable)
+            f |= item_first
+            n = n or item_nullable
+        return (f, n)
+    if isinstance(node, Repeat):
+        f, n = compute_first(node.item, rule_table, first, nullable)
+        return (f, n or node.min_reps == 0)
+    if isinstance(node, Optional):
+        f, n = compute_first(node.item, rule_table, first, nullable)
+        return (f, True)
+    assert isinstance(node, FnWrapper), node
+    return compute_first(node.rule, rule_table, first, nullable)
+
+# Walk a rule tree and hand every alternation its dispatch table
+def compile_dispatch(node, rule_table, first, nullable):
+    if isinstance(node, Alternation):
+        for item in node.items:
+            compile_dispatch(item, rule_table, first, nullable)
+        node.compile_first([compute_first(item, rule_table, first, nullable)
+                for item in node.items])
+    elif isinstance(node, Sequence):
+        for item in node.items:
+            compile_dispatch(item, rule_table, first, nullable)
+    elif isinstance(node, Repeat):
+        compile_dispatch(node.item, rule_table, first, nullable)
+        f, n = compute_first(node.item, rule_table, first, nullable)
+        # Only prune on lookahead if the item can't match zero tokens (if it can,
+        # an iteration might succeed on any lookahead)
+        if not n:
+            node.first = frozenset(f)
+    elif isinstance(node, Optional):
+        compile_dispatch(node.item, rule_table, first, nullable)
+    elif isinstance(node, FnWrapper):
+        compile_dispatch(node.rule, rule_table, first, nullable)
+
+# Check whether a grammar uses the cut operator anywhere, so the code generator
+# only emits the flag checks for grammars that need them
+def contains_cut(node):
+    if isinstance(node, CutSequence):
+        return True
+    if isinstance(node, (Sequence, Alternation)):
+        return any(contains_cut(item) for item in node.items)
+    if isinstance(node, (Repeat, Optional)):
+        return contains_cut(node.item)
+    if isinstance(node, FnWrapper):
+        return contains_cut(node.rule)
+    return False
+
+# Code generator for grammars: compiles each rule's grammar tree into one specialized
+# Python function, built as source text and exec'd. This cuts out all the per-node
+# method dispatch of the tree-walking parse() path--sequences become straight-line
+# code, rule references become direct calls between the generated functions, and the
+# tokenizer/accept lookups are hoisted to one binding per rule invocation. The
+# functions follow the exact same result protocol as the parse() methods, so user
+# functions and error reporting behave identically.
+class CodeGen:
+    def __init__(self, rule_table, memo_rules=frozenset()):
+        self.rule_table = rule_table
+        self.memo_rules = memo_rules
+        self.has_cut = any(contains_cut(rule) for rule in rule_table.values())
+        self.lines = []
+        self.temp = 0
+        self.globals = {'ParseResult': ParseResult, 'merge_info_list': merge_info_list}
+
+    def var(self):
+        self.temp += 1
+        return '_t%d' % self.temp
+
+    # Bind a Python object (a user function, in practice) to a name in the generated
+    # module's namespace
+    def bind(self, value):
+        name = '_fn%d' % len(self.globals)
+        self.globals[name] = value
+        return name
+
+    def line(self, indent, text):
+        self.lines.append('    ' * indent + text)
+
+    # Emit the code for one grammar node, assigning its parse result (in the same
+    # format parse() would return) to the variable named by target
+    def gen_node(self, node, indent, target):
+        line = self.line
+        if isinstance(node, RuleRef):
+            line(indent, '%s = _rule_%s(ctx)' % (target, node.name))
+        elif isinstance(node, TokenRef):
+            tok = self.var()
+            line(indent, '%s = accept(%r)' % (tok, node.name))
+            line(indent, '%s = None if %s is None else (%s.value, %s.info)' %
+                    (target, tok, tok, tok))
+        elif isinstance(node, Sequence):
+            cut_pos = node.cut_pos if isinstance(node, CutSequence) else None
+            pos, vals, infos = self.var(), self.var(), self.var()
+            line(indent, '%s = tokenizer.pos' % pos)
+            line(indent, '%s = []' % vals)
+            line(indent, '%s = []' % infos)
+            ind = indent
+            for i, item in enumerate(node.items):
+                result = self.var()
+                self.gen_node(item, ind, result)
+                line(ind, 'if %s is None:' % result)
+                line(ind + 1, '%s = None' % target)
+                if cut_pos is not None and i >= cut_pos:
+                    line(ind + 1, 'ctx.cut = True')
+                line(ind, 'else:')
+                ind += 1
+                line(ind, '%s.append(%s[0])' % (vals, result))
+                line(ind, '%s.append(%s[1])' % (infos, result))
+            line(ind, '%s = [%s, %s]' % (target, vals, infos))
+            line(indent, 'if %s is None:' % target)
+            line(indent + 1, 'tokenizer.pos = %s' % pos)
+        elif isinstance(node, Alternation):
+            ind = indent
+            for i, item in enumerate(node.items):
+                if i:
+                    if self.has_cut:
+                        line(ind, 'if %s is None and not ctx.cut:' % target)
+                    else:
+                        line(ind, 'if %s is None:' % target)
+                    ind += 1
+                self.gen_node(item, ind, target)
+            if self.has_cut:
+                # A failed alternative that crossed a cut rules out the others,
+                # but the commitment stops at this alternation
+                line(indent, 'if ctx.cut:')
+                line(indent + 1, 'ctx.cut = False')
+        elif isinstance(node, Repeat):
+            pos, vals, infos = self.var(), self.var(), self.var()
+            result = self.var()
+            line(indent, '%s = tokenizer.pos' % pos)
+            line(indent, '%s = []' % vals)
+            line(indent, '%s = []' % infos)
+            line(indent, 'while True:')
+            self.gen_node(node.item, indent + 1, result)
+            line(indent + 1, 'if %s is None:' % result)
+            line(indent + 2, 'break')
+            line(indent + 1, '%s.append(%s[0])' % (vals, result))
+            line(indent + 1, '%s.append(%s[1])' % (infos, result))
+            if self.has_cut:
+                line(indent, 'if ctx.cut:')
+                line(indent + 1, 'tokenizer.pos = %s' % pos)
+                line(indent + 1, '%s = None' % target)
+                line(indent, 'else:')
+                indent += 1
+            if node.min_reps:
+                line(indent, 'if len(%s) >= %d:' % (vals, node.min_reps))
+                line(indent + 1, '%s = [%s, %s]' % (target, vals, infos))
+                line(indent, 'else:')
+                line(indent + 1, 'tokenizer.pos = %s' % pos)
+                line(indent + 1, '%s = None' % target)
+            else:
+                line(indent, '%s = [%s, %s]' % (target, vals, infos))
+        elif isinstance(node, Optional):
+            self.gen_node(node.item, indent, target)
+            if self.has_cut:
+                line(indent, 'if %s is None and not ctx.cut:' % target)
+            else:
+                line(indent, 'if %s is None:' % target)
+            line(indent + 1, '%s = (None, None)' % target)
+        elif isinstance(node, FnWrapper):
+            result, out = self.var(), self.var()
+            self.gen_node(node.rule, indent, result)
+            fn = self.bind(node.fn)
+            line(indent, 'if %s is None:' % result)
+            line(indent + 1, '%s = None' % target)
+            line(indent, 'else:')
+            if node.wrap:
+                line(indent + 1, '%s = ([%s[0]], [%s[1]])' % (result, result, result))
+            if node.fast:
+                # See FnWrapper.__init__: no ParseResult needed for functions that
+                # can't call its methods (they may still pass the bare list onward)
+                line(indent + 1, '%s = %s(%s[0])' % (out, fn, result))
+                line(indent + 1, 'if %s is %s[0]:' % (out, result))
+                line(indent + 2, '%s = (%s[0], %s[1])' % (target, result, result))
+                line(indent + 1, 'else:')
+                line(indent + 2, '%s = (%s, merge_info_list(%s[1]))' %
+                        (target, out, result))
+            else:
+                line(indent + 1, '%s = %s(ParseResult(ctx, %s[0], %s[1]))' %
+                        (out, fn, result, result))
+                line(indent + 1, 'if isinstance(%s, ParseResult):' % out)
+                line(indent + 2, '%s = (%s.items, %s.info)' % (target, out, out))
+                line(indent + 1, 'else:')
+                line(indent + 2, '%s = (%s, merge_info_list(%s[1]))' %
+                        (target, out, result))
+        else:
+            assert False, 'unknown grammar node %s' % node
+
+    # Emit one function per rule. The memo table is checked dynamically so the
+    # generated code works both with and without packrat memoization.
+    def gen_rule(self, name, rule):
+        line = self.line
+        line(0, 'def _rule_%s(ctx):' % name)
+        # Per-rule-memoized rules use the table whenever it exists; the rest only
+        # under a parser-wide memoize
+        if name in self.memo_rules:
+            memo_cond = 'memo is not None'
+        else:
+            memo_cond = 'memo is not None and ctx.memo_all'
+        line(1, 'memo = ctx.memo')
+        line(1, 'if %s:' % memo_cond)
+        line(2, 'key = (%r, ctx.tokenizer.pos)' % name)
+        line(2, 'hit = memo.get(key)')
+        line(2, 'if hit is not None:')
+        line(3, 'ctx.tokenizer.pos = hit[1]')
+        line(3, 'return hit[0]')
+        line(1, 'tokenizer = ctx.tokenizer')
+        line(1, 'accept = tokenizer.accept')
+        result = self.var()
+        self.gen_node(rule, 1, result)
+        if self.has_cut:
+            # Cuts are scoped to the rule they appear in--see RuleRef.parse
+            line(1, 'if ctx.cut:')
+            line(2, 'ctx.cut = False')
+        line(1, 'if %s:' % memo_cond)
+        line(2, 'memo[key] = (%s, ctx.tokenizer.pos)' % result)
+        line(1, 'return %s' % result)
+
+    def build(self):
+        namespace = dict(self.globals)
+        source = '\n'.join(self.lines)
+        exec(compile(source, '<sprdpl generated>', 'exec'), namespace)
+        return {name: namespace['_rule_' + name] for name in self.rule_table}
+
 # Mini parser for our grammar specification language (basically EBNF)
 
 # After either a parenthesized group or an identifier, we accept * and + for
@@ -200,11 +726,21 @@ def parse_rule_atom(tokenizer):
 # Parse the concatenation of one or more expressions
 def parse_rule_seq(tokenizer):
     items = []
+    cut_pos = None
     token = tokenizer.peek()
     while (token and token.type != 'RBRACKET' and token.type != 'RPAREN' and
             token.type != 'PIPE'):
-        items.append(parse_rule_atom(tokenizer))
+        # A ! here is a cut: it commits the parse to this alternative once
+        # everything before it has matched. Only the first one matters--the
+        # parse is already committed by the time any later one is reached.
+        if tokenizer.accept('CUT'):
+            if cut_pos is None:
+                cut_pos = len(items)
+        else:
+            items.append(parse_rule_atom(tokenizer))
         token = tokenizer.peek()
+    if cut_pos is not None and items:
+        return CutSequence(items, cut_pos)
     # Only return a sequence if there's multiple items, otherwise there's way
     # too many [0]s when extracting parsed items in complicated rules
     if len(items) > 1:
@@ -232,6 +768,7 @@ rule_tokens = {
     'RPAREN':     r'\)',
     'STAR':       r'\*',
     'PLUS':       r'\+',
+    'CUT':        r'!',
     'WHITESPACE': (r' ', lambda t: None),
 }
 rule_lexer = lex.Lexer(rule_tokens)
@@ -246,22 +783,95 @@ def rule_fn(rule_table, name, rule):
         return fn
     return wrapper
 
+# Cache of finalized rule tables. Building a grammar means lexing and parsing every
+# production string, which is pure overhead when the same grammar is used to construct
+# many Parser objects (scripts and tests do this a lot). The key is the textual grammar
+# plus the identity of any user functions--holding the functions in the key also keeps
+# them alive, so we can't get fooled by id() reuse.
+_GRAMMAR_CACHE = {}
+
+# Compiled (code-generated) rule tables, shared between Parsers built from the same
+# cached grammar so the codegen runs once per grammar per process. Keyed by the
+# rule table's id(); each entry keeps a reference to the table itself, so the id
+# can never be reused while the cache entry exists.
+_COMPILED_CACHE = {}
+
 class Parser:
-    def __init__(self, rule_table, start):
+    __slots__ = ['rule_table', 'start', 'memoize', 'memo_rules', 'compiled_table']
+    # The memoize flag enables packrat memoization of nonterminals. It's opt-in: for
+    # grammars that backtrack a lot it turns exponential parses into linear ones, but
+    # for grammars that mostly parse straight through it just adds overhead.
+    # The compile flag runs the code generator up front (see the compile() method),
+    # for callers that would otherwise construct and then immediately compile.
+    def __init__(self, rule_table, start, memoize=False, compile=False):
+        # Each rule's productions can be preceded by an options dict; right now the
+        # only option is {'memoize': True}, which turns on packrat memoization for
+        # just that rule (for selectively defusing the backtracking-heavy rules of a
+        # grammar without the table upkeep everywhere else)
+        self.memo_rules = {name for [name, *rules] in rule_table
+                if rules and isinstance(rules[0], dict) and rules[0].get('memoize')}
+        key = tuple((name, tuple(tuple(sorted(rule.items())) if isinstance(rule, dict)
+                else rule if isinstance(rule, str) else (rule[0], rule[1])
+                for rule in rules)) for [name, *rules] in rule_table)
+        self.memoize = memoize
+        self.compiled_table = None
+        cached = _GRAMMAR_CACHE.get(key)
+        if cached is not None:
+            self.rule_table = cached
+            self.start = start
+            if compile:
+                self.compile()
+            return
+
         self.rule_table = {}
         for [name, *rules] in rule_table:
             for rule in rules:
+                if isinstance(rule, dict):
+                    continue
                 fn = None
                 if isinstance(rule, tuple):
                     rule, fn = rule
                 self.create_rule(name, rule, fn)
-        # Finalize rules: any time we see a alternation with just one rule, simplify it
-        # to just the one rule. We keep every top-level rules inside alternations in case
-        # it gets repeated, so we take that out where it's not necessary now.
+        # Finalize rules: flatten out degenerate nodes, and any time we see a alternation
+        # with just one rule, simplify it to just the one rule. We keep every top-level
+        # rules inside alternations in case it gets repeated, so we take that out where
+        # it's not necessary now.
         for name, rule in self.rule_table.items():
+            rule = simplify(rule)
             if isinstance(rule, Alternation) and len(rule.items) == 1:
-                self.rule_table[name] = rule.items[0]
+                rule = rule.items[0]
+            self.rule_table[name] = rule
+
+        # Resolve rule references to the actual rule objects. This has to happen after
+        # the simplification above (so references point at the final objects) and before
+        # the lookahead compilation below (so the dispatch tables hold resolved nodes)
+        for name, rule in self.rule_table.items():
+            self.rule_table[name] = resolve_identifiers(rule, self.rule_table,
+                    self.memo_rules)
+
+        # Compute the FIRST set of every rule with a standard fixpoint iteration, then
+        # give each alternation a dispatch table over its lookahead token, so it only
+        # has to try the alternatives that can actually start with the next token
+        first = {name: set() for name in self.rule_table}
+        nullable = {name: False for name in self.rule_table}
+        changed = True
+        while changed:
+            changed = False
+            for name, rule in self.rule_table.items():
+                f, n = compute_first(rule, self.rule_table, first, nullable)
+                if not f <= first[name]:
+                    first[name] |= f
+                    changed = True
+                if n and not nullable[name]:
+                    nullable[name] = True
+                    changed = True
+        for rule in self.rule_table.values():
+            compile_dispatch(rule, self.rule_table, first, nullable)
+
+        _GRAMMAR_CACHE[key] = self.rule_table
         self.start = start
+        if compile:
+            self.compile()
 
     def create_rule(self, name, rule, fn):
         # Parse the EBNF grammar specification for this rule
@@ -277,22 +887,108 @@ class Parser:
         #   name: rule_2
         # ...is equivalent to:
         #   name: rule_1 | rule_2
-        if name not in self.rule_table:
-            self.rule_table[name] = Alternation([])
-        self.rule_table[name].items.append(rule)
+        self.rule_table.setdefault(name, Alternation([])).items.append(rule)
+
+    # Generate specialized parsing functions for the whole grammar (see CodeGen above)
+    # and use them for subsequent parse() calls. Opt-in, since the generated code trades
+    # a chunk of construction time for faster parsing.
+    def compile(self):
+        cached = _COMPILED_CACHE.get(id(self.rule_table))
+        if cached is not None:
+            self.compiled_table = cached[1]
+            return
+        gen = CodeGen(self.rule_table, self.memo_rules)
+        for name, rule in self.rule_table.items():
+            gen.gen_rule(name, rule)
+        self.compiled_table = gen.build()
+        _COMPILED_CACHE[id(self.rule_table)] = (self.rule_table, self.compiled_table)
+
+    # Offline pregeneration: return the source of a Python module holding the
+    # generated parser for this grammar, so later runs can skip grammar construction
+    # and code generation entirely (and get .pyc caching for free). The module can't
+    # contain the user functions themselves; from_prebuilt() passes them back in at
+    # import time, pulled out of the original rule table grouped by rule name in
+    # first-appearance order--the order the code generator bound them in, since it
+    # works through the finalized rule table one whole rule at a time.
+    def pregen(self):
+        gen = CodeGen(self.rule_table, self.memo_rules)
+        for name, rule in self.rule_table.items():
+            gen.gen_rule(name, rule)
+        fn_names = [name for name in gen.globals if name.startswith('_fn')]
+        lines = ['# Parser module generated by sprdpl Parser.pregen(). Do not edit.',
+                'from sprdpl.parse import ParseResult, merge_info_list',
+                '']
+        lines += gen.lines
+        lines += ['',
+                '_FN_NAMES = %r' % (fn_names,),
+                '_RULES = {%s}' % ', '.join('%r: _rule_%s' % (name, name)
+                        for name in self.rule_table),
+                '',
+                'def load(fns):',
+                "    assert len(fns) == len(_FN_NAMES), 'wrong number of user functions'",
+                '    globals().update(zip(_FN_NAMES, fns))',
+                '    return _RULES',
+                '']
+        return '\n'.join(lines)
+
+    # Build a Parser from a module written out by pregen(). The rule table here is
+    # only scanned for its user functions--none of the grammar strings get lexed,
+    # parsed, or compiled.
+    @classmethod
+    def from_prebuilt(cls, module, rule_table, start, memoize=False):
+        # Collect the functions grouped by rule name, in order of each name's first
+        # appearance--entries for the same rule can be interleaved with other rules
+        # (that's how the rule_fn decorator lays them out), but the code generator
+        # binds each rule's functions together
+        fns_by_name = {}
+        for [name, *rules] in rule_table:
+            fn_list = fns_by_name.setdefault(name, [])
+            for rule in rules:
+                if isinstance(rule, tuple):
+                    fn_list.append(rule[1])
+        fns = [fn for fn_list in fns_by_name.values() for fn in fn_list]
+        self = cls.__new__(cls)
+        self.memoize = memoize
+        self.memo_rules = {name for [name, *rules] in rule_table
+                if rules and isinstance(rules[0], dict) and rules[0].get('memoize')}
+        self.rule_table = {}
+        self.compiled_table = module.load(fns)
+        self.start = start
+        return self
 
     def parse(self, tokenizer, start=None, user_context=None, lazy=False):
-        rule = self.rule_table[start or self.start]
-        ctx = Context(self.rule_table, tokenizer, user_context=user_context)
+        start = start or self.start
+        parse_rule = (self.compiled_table[start] if self.compiled_table is not None
+                else self.rule_table[start].parse)
+        start_pos = tokenizer.pos
+        # Rewinding and reparsing isn't safe on a live token stream: user functions
+        # run again during the replay, and one that calls set_token_list() would
+        # send() into the coroutine a second time and mislex a token we've already
+        # cached. Track errors on the first pass instead--the two-pass optimization
+        # only applies to fully-lexed input.
+        if tokenizer.token_stream is not None:
+            tokenizer.track_errors = True
+        ctx = Context(self.rule_table, tokenizer, user_context=user_context,
+                memoize=self.memoize, memo_rules=bool(self.memo_rules))
         try:
-            result = rule.parse(ctx)
+            result = parse_rule(ctx)
+            fail = (result is None or tokenizer.peek() is not None)
+            if fail and not tokenizer.track_errors:
+                # The expected-token bookkeeping in accept() is skipped during normal
+                # parsing, so we don't know where this parse got stuck or what could
+                # have come next. Rewind and parse again with tracking turned on to
+                # find out--only failed parses pay for the second pass. (This does
+                # mean user functions run again for the parts that re-succeed.)
+                tokenizer.pos = start_pos
+                tokenizer.track_errors = True
+                ctx = Context(self.rule_table, tokenizer, user_context=user_context,
+                        memoize=self.memoize, memo_rules=bool(self.memo_rules))
+                result = parse_rule(ctx)
         except lex.LexError as e:
             # Kinda hacky, wrap LexErrors in ParseErrors since we don't have access to the
             # LexerContext where they are created
             raise ParseError(tokenizer, e.msg, e.info)
 
-        fail = (not result or tokenizer.peek() is not None)
-
         # If we're in lazy mode, check if we didn't parse a full element but could have. If
         # there was a parse error, we will have given up before reaching the end of the token stream.
         if lazy and fail and tokenizer.got_to_end():